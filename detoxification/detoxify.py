@@ -4,10 +4,13 @@
 
 # Import all necessary libraries.
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import argparse
 from transformers import pipeline, BertTokenizer, BertModel
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
+import torch.nn.functional as F
 
 def create_arg_parser():
     parser = argparse.ArgumentParser()
@@ -33,36 +36,69 @@ def read_corpus(corpus_file):
     Returns:
         documents (List[str]), labels (List[str]): 2 lists of texts and labels respectively.
     """
-    documents = []
-    labels = []
+    corpus = pacsv.read_csv(corpus_file,
+                            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+                            parse_options=pacsv.ParseOptions(delimiter='\t', newlines_in_values=True))
 
-    corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
+    # Prediction files also contain an index column, texts and labels are always the last two columns
+    texts = corpus.column(corpus.num_columns - 2)
+    labels = corpus.column(corpus.num_columns - 1)
+    is_offensive = pc.equal(labels, "OFF")
 
-    offensive_documents = corpus[corpus['label'] == "OFF"]
-    
-    documents = offensive_documents['text'].to_list()
-    labels = offensive_documents['label'].to_list()
+    documents = pc.filter(texts, is_offensive).to_pylist()
+    labels = pc.filter(labels, is_offensive).to_pylist()
 
     return documents, labels
 
 
-def get_embeddings(sentence, model, tokenizer):
+def get_embeddings(sentences, model, tokenizer, batch_size=64):
     """
-    Function computes embeddings of a sentence.
+    Function computes embeddings of sentences, batch by batch.
     Args:
-        sentence (str): sentence.
+        sentences (List[str]): list of sentences.
         model: model to get embeddings.
-        tokenizer: tokenizer to tokenize sentence.
+        tokenizer: tokenizer to tokenize sentences.
+        batch_size (int): number of sentences per forward pass.
 
     Returns:
-        bert_embedding: model embeddings.
+        bert_embeddings: model embeddings (kept on the GPU), one row per sentence.
     """
-    inputs = tokenizer(sentence, return_tensors="pt", padding=True, truncation=True)
-    with torch.no_grad():
-        outputs = model(**inputs.to("cuda"))
-        bert_embedding = outputs.last_hidden_state.cpu().mean(dim=1)
+    bert_embeddings = []
+    for start in range(0, len(sentences), batch_size):
+        inputs = tokenizer(sentences[start:start + batch_size], return_tensors="pt", padding=True,
+                           truncation=True).to("cuda")
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            outputs = model(**inputs)
+        # Average over real tokens only, so padding doesn't change the sentence embedding
+        mask = inputs["attention_mask"].unsqueeze(-1).float()
+        hidden_states = outputs.last_hidden_state.float()
+        bert_embeddings.append((hidden_states * mask).sum(dim=1) / mask.sum(dim=1))
 
-    return bert_embedding
+    return torch.cat(bert_embeddings)
+
+
+def get_predictions(sentences, model, tokenizer, batch_size=64):
+    """
+    Function classifies sentences, batch by batch.
+    Args:
+        sentences (List[str]): list of sentences.
+        model: classification model.
+        tokenizer: tokenizer to tokenize sentences.
+        batch_size (int): number of sentences per forward pass.
+
+    Returns:
+        labels (List[str]): predicted model labels (e.g. LABEL_1), one per sentence.
+    """
+    preds = []
+    for start in range(0, len(sentences), batch_size):
+        # Same max length as used when fine-tuning the classifier
+        inputs = tokenizer(sentences[start:start + batch_size], return_tensors="pt", padding=True,
+                           truncation=True, max_length=64).to("cuda")
+        with torch.inference_mode():
+            logits = model(**inputs).logits
+        preds.extend(logits.argmax(dim=-1).cpu().tolist())
+
+    return [model.config.id2label[pred] for pred in preds]
 
 
 if __name__ == "__main__":
@@ -74,21 +110,22 @@ if __name__ == "__main__":
 
     # Detoxify texts
     if args.detox:
-        pipe = pipeline("text2text-generation", model="s-nlp/bart-base-detox")
-        detoxified_documents = []
-        for output in pipe(offensive_documents):
-            detoxified_documents.append(output['generated_text'])
+        pipe = pipeline("text2text-generation", model="s-nlp/bart-base-detox", device=0,
+                        model_kwargs={"torch_dtype": torch.float16})
+        # Generate in batches, tokenization of the next batches runs in DataLoader workers
+        detoxified_documents = [output['generated_text']
+                                for output in pipe(offensive_documents, batch_size=32, num_workers=2)]
 
         # Get BERT embeddings for two sentences 
         tokenizer = BertTokenizer.from_pretrained("bert-base-cased")
         model = BertModel.from_pretrained("bert-base-cased").to("cuda")
 
-        cos_sims = []
-
-        for n, text in enumerate(offensive_documents):
-            emb_sent1 = get_embeddings(text, model, tokenizer)
-            emb_sent2 = get_embeddings(detoxified_documents[n], model, tokenizer)
-            cos_sims.append(cosine_similarity(emb_sent1, emb_sent2)[0][0])
+        # Embed original and detoxified texts together, then split them back
+        embeddings = get_embeddings(offensive_documents + detoxified_documents, model, tokenizer)
+        emb_sents1 = embeddings[:len(offensive_documents)]
+        emb_sents2 = embeddings[len(offensive_documents):]
+        # Similarities are computed on the GPU, only the final vector is copied back
+        cos_sims = F.cosine_similarity(emb_sents1, emb_sents2, dim=1).cpu().numpy().tolist()
 
         data = {'original': offensive_documents, 'detoxified': detoxified_documents, 'similarity': cos_sims,
                 'orig_label': offensive_labels} 
@@ -103,10 +140,12 @@ if __name__ == "__main__":
         print("Number of detoxified rows:", len(detoxified_rows))
 
         # Classify whether new detoxified text is still offensive 
-        offensive_detection = pipeline("text-classification", model="checkpoint-roberta-best")
-        preds = offensive_detection(detoxified_rows['detoxified'].to_list())
+        clf_tokenizer = AutoTokenizer.from_pretrained("checkpoint-roberta-best")
+        clf_model = AutoModelForSequenceClassification.from_pretrained("checkpoint-roberta-best",
+                                                                       torch_dtype=torch.float16).to("cuda").eval()
+        preds = get_predictions(detoxified_rows['detoxified'].to_list(), clf_model, clf_tokenizer)
         
-        preds = [idx_to_label[output['label']] for output in preds]
+        preds = [idx_to_label[label] for label in preds]
 
         # Save results
         data = {'original': detoxified_rows['original'].to_list(), 'detoxified': detoxified_rows['detoxified'].to_list(),
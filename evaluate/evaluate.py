@@ -3,7 +3,8 @@
 """Models evaluation."""
 
 # Import all necessary libraries.
-import pandas as pd
+import numpy as np
+import pyarrow.csv as pacsv
 import argparse
 import matplotlib.pyplot as plt
 import seaborn as sn
@@ -37,13 +38,13 @@ def read_corpus(corpus_file):
     Returns:
         documents (List[str]), labels (List[str]): 2 lists of texts and labels respectively.
     """
-    documents = []
-    labels = []
+    corpus = pacsv.read_csv(corpus_file,
+                            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+                            parse_options=pacsv.ParseOptions(delimiter='\t', newlines_in_values=True))
 
-    corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
-    
-    documents = corpus['text'].to_list()
-    labels = corpus['label'].to_list()
+    # Preprocessed files also contain an index column, texts and labels are always the last two columns
+    documents = corpus.column(corpus.num_columns - 2).to_pylist()
+    labels = corpus.column(corpus.num_columns - 1).to_pylist()
 
     return documents, labels
 
@@ -52,28 +53,27 @@ def get_confusion_matrix(y_test, y_pred, classes):
     """
     Make predictions and measure accuracy on our own test set (that we split off train).
     Args:
-        X_test (list): test documents.
         y_test (list): test labels.
         y_pred (list): predicted labels.
+        classes (list): labels in the order they are shown in the matrix.
 
     Returns:
         None
     """
 
-    confusion_matrix_result = confusion_matrix(y_test, y_pred)
+    # Rows and columns follow the order of classes, so they always match the tick labels
+    confusion_matrix_result = confusion_matrix(np.asarray(y_test), np.asarray(y_pred), labels=classes)
 
     # plot confusion matrix
     ax = plt.subplot()
 
-    # annot=True to annotate cells, ftm='g' to disable scientific notation
-    sn.heatmap(confusion_matrix_result, annot=True, fmt="g", ax=ax)
+    # annot=True to annotate cells, ftm='d' to print integer counts
+    sn.heatmap(confusion_matrix_result, annot=True, fmt="d", xticklabels=classes, yticklabels=classes, ax=ax)
 
-    # labels, title and ticks
+    # labels and title
     ax.set_xlabel("Predicted labels")
     ax.set_ylabel("True labels")
     ax.set_title("Confusion Matrix")
-    ax.xaxis.set_ticklabels(classes)
-    ax.yaxis.set_ticklabels(classes)
 
     ax.figure.savefig("LM_confusion_matrix.png")
 
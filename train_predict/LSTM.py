@@ -6,19 +6,26 @@ Exploring binary text classification task using LSTM.
 
 import random as python_random
 import argparse
+import csv
+import hashlib
+import os
+import re
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 from keras.models import Sequential
-from keras.layers import Dense, Embedding, LSTM, Bidirectional
+from keras.layers import Dense, Dropout, Embedding, LSTM, Bidirectional
 from sklearn.metrics import f1_score
 from keras.initializers import Constant
-from keras import backend as K
 from sklearn.preprocessing import LabelBinarizer
 from tensorflow.keras.optimizers import SGD, Adam
+from tensorflow.keras.metrics import F1Score
 from tensorflow.keras.layers import TextVectorization
+from tensorflow.keras import mixed_precision
 import tensorflow as tf
 import emoji
-from wordsegment import load, segment
+from hashtags import hashtag_cache, save_hashtag_cache, segment_hashtag
+
 
 # Make reproducible as much as possible
 np.random.seed(1234)
@@ -47,10 +54,15 @@ def create_arg_parser():
     
     parser.add_argument("--bilstm", action="store_true", help="Whether to use Bidirectional LSTM.")
 
+    # Compilation arguments
+    parser.add_argument("--jit_compile", action="store_true",
+                        help="Whether to compile the whole train step with XLA (off by default). "
+                             "The LSTM layers then can't use the fused cuDNN kernel.",)
+
     # Hyperparameters arguments
     parser.add_argument("--epochs", default=30, type=int, help="Set number of epochs")
     parser.add_argument("--lr", default=0.001, type=float, help="Set learning rate")
-    parser.add_argument("--batch_size", default=32, type=int, help="Set batch size")
+    parser.add_argument("--batch_size", default=256, type=int, help="Set batch size (per GPU)")
     parser.add_argument("--dropout", default=0.2, type=float, help="Set dropout rate")
     parser.add_argument("--optimizer", default="Adam", choices=["Adam", "SGD"], 
                         help="Set optimizer (default Adam)",)
@@ -66,105 +78,229 @@ def create_arg_parser():
     return args
 
 
-def read_corpus(corpus_file, preprocessed=True):
+def read_corpus(corpus_file):
     """
     Function that reads the corpus and gets texts and labels from it.
     Args:
         corpus_file (str): Path to corpus file.
-        preprocessed (bool): Whether tex
 
     Returns:
-        documents (List[str]), labels (List[str]): 2 lists of texts and labels respectively.
+        documents (np.array), labels (np.array): 2 arrays of texts and labels respectively.
     """
-    documents = []
-    labels = []
-
-    if preprocessed:
-      corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
-    else:
-      corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
+    corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
 
-    documents = corpus['text'].to_list()
-    labels = corpus['label'].to_list()
+    # Columns are taken as arrays directly, both TextVectorization and LabelBinarizer accept them
+    documents = corpus['text'].to_numpy()
+    labels = corpus['label'].to_numpy()
 
     return documents, labels
 
 
+def parse_embeddings(embeddings_file):
+    """
+    Function that parses embeddings from the text file.
+    Args:
+        embeddings_file (str): Path to embedding file.
+
+    Returns:
+        words (List[str]), vectors (np.array): words and the float32 matrix with their embeddings.
+    """
+    # Embedding dimension from the first line (word followed by its values)
+    with open(embeddings_file, 'r', encoding='utf-8') as glove:
+        embedding_dim = len(glove.readline().split()) - 1
+
+    # The C parser tokenizes and converts the floats in one pass. Words are kept as
+    # they are: no quoting and no NaN detection (e.g. for words like "null" or "nan").
+    column_types = {col: np.float32 for col in range(1, embedding_dim + 1)}
+    column_types[0] = str
+    glove = pd.read_csv(embeddings_file, sep=' ', header=None, engine='c', encoding='utf-8',
+                        quoting=csv.QUOTE_NONE, na_filter=False, keep_default_na=False,
+                        usecols=range(embedding_dim + 1), dtype=column_types)
+
+    words = glove[0].tolist()
+    vectors = glove.iloc[:, 1:].to_numpy(dtype=np.float32)
+
+    return words, vectors
+
+
 def read_embeddings(embeddings_file):
     """
     Function that reads embeddings from the file.
+    The text file is parsed only once: words and vectors are cached next to it
+    and the vectors are memory-mapped on the following runs.
     Args:
         embeddings_file (str): Path to embedding file.
 
     Returns:
-        (dict): dictionary with words and their corresponding embeddings.
+        words (List[str]), vectors (np.array): words and the float32 matrix with their embeddings.
     """
-    embedding_dict = {}
-    with open(embeddings_file, 'r') as glove:
-      for line in glove:
-        values = line.split()
-        word = values[0]
-        vectors = np.asarray(values[1:], 'float32')
-        embedding_dict[word] = vectors
+    words_file = embeddings_file + '.words'
+    vectors_file = embeddings_file + '.npy'
+
+    # The cache is rebuilt when the embeddings file was replaced after it was written
+    cache_files = [words_file, vectors_file]
+    if all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(embeddings_file) for f in cache_files):
+        with open(words_file, 'r', encoding='utf-8') as f:
+            words = f.read().split('\n')
+        vectors = np.load(vectors_file, mmap_mode='r')
+    else:
+        words, vectors = parse_embeddings(embeddings_file)
+        np.save(vectors_file, vectors)
+        with open(words_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(words))
+
+    return words, vectors
+
+
+# A single scan of a text handles all the substitutions: @USER mentions, URL placeholders
+# and hashtags (words starting with #, mentions glued in front of them are dropped too)
+CLEANING_PATTERN = re.compile(r'(?<!\S)(?:@USER)*#(\S*)|@USER|URL')
+
+
+def substitute_match(match):
+    """
+    Function that gets the replacement of a CLEANING_PATTERN match.
+    Args:
+        match (re.Match): matched @USER, URL or hashtag.
 
-    return embedding_dict
+    Returns:
+        (str): text to put instead of the match.
+    """
+    token = match.group()
+    if token == '@USER':
+        return ''
+    if token == 'URL':
+        return 'http'
+    return segment_hashtag(get_hashtag(match))
+
+
+def get_hashtag(match):
+    """
+    Function that gets the hashtag (as it's segmented) from a CLEANING_PATTERN match.
+    Args:
+        match (re.Match): matched hashtag.
+
+    Returns:
+        (str): hashtag without # signs.
+    """
+    hashtag = match.group(1).replace('@USER', '').replace('URL', 'http')
+    return hashtag.replace("#", "")
+
+
+def clean_document(doc):
+    """
+    Function that cleans and preprocesses a single text.
+    Args:
+        doc (str): text with emojis already converted (emoji.demojize).
+
+    Returns:
+        cleaned_doc (str): cleaned and preprocessed text.
+    """
+    doc = CLEANING_PATTERN.sub(substitute_match, doc)
+    cleaned_doc = " ".join(doc.split())
+
+    return cleaned_doc
 
 
 def preprocessing(documents):
     """
-    Function that clean and preprocess texts.
+    Function that clean and preprocess texts. The costly steps (emoji conversion and
+    segmentation of new hashtags) run in parallel in a pool of worker processes (one per CPU core).
     Args:
         documents (List[str]): list of texts.
 
     Returns:
-        cleaned_hash_docs (List[str]): list of cleaned and preprocessed texts.
+        cleaned_docs (List[str]): list of cleaned and preprocessed texts.
+    """
+    with mp.Pool() as pool:
+        demojized_docs = pool.map(emoji.demojize, documents, chunksize=256)
+
+        # Workers can't add to the hashtag cache of this process, so the hashtags missing from it
+        # are segmented by the pool and stored here. Hashtags are taken from the demojized texts,
+        # i.e. exactly as clean_document() looks them up.
+        hashtags = {get_hashtag(match) for doc in demojized_docs for match in CLEANING_PATTERN.finditer(doc)
+                    if match.group(1) is not None}
+        new_hashtags = [hashtag for hashtag in hashtags if hashtag not in hashtag_cache]
+        if new_hashtags:
+            hashtag_cache.update(zip(new_hashtags, pool.map(segment_hashtag, new_hashtags, chunksize=64)))
+            save_hashtag_cache()
+
+    # All the hashtags are in the cache now, what's left is a single regex scan per text
+    cleaned_docs = [clean_document(doc) for doc in demojized_docs]
+
+    return cleaned_docs
+
+
+def read_preprocessed(corpus_file, documents):
+    """
+    Function that gets the cleaned and preprocessed texts of a corpus file. They are cached
+    next to the file, so texts are only processed again when the file changes.
+    Args:
+        corpus_file (str): Path to corpus file.
+        documents (np.array): texts read from the file.
+
+    Returns:
+        cleaned_docs (np.array): cleaned and preprocessed texts.
     """
-    cleaned_user_docs = [doc.replace('@USER', '') for doc in documents]
-    cleaned_url_docs = [doc.replace('URL', 'http') for doc in cleaned_user_docs]
-    cleaned_emoji_docs = [emoji.demojize(doc) for doc in cleaned_url_docs]
-
-    cleaned_hash_docs = []
-    for doc in cleaned_emoji_docs:
-        cleaned_doc = ''
-        for word in doc.split():
-            if word.startswith("#"):
-                word = word.replace("#", "")
-                load()
-                word_list = segment(word)
-                word = ' '.join(word_list)
-            cleaned_doc = cleaned_doc + ' ' + word
-        cleaned_doc = " ".join(cleaned_doc.split())
-        cleaned_hash_docs.append(cleaned_doc)
-
-    return cleaned_hash_docs
-
-
-def get_emb_matrix(voc, emb):
+    cache_file = corpus_file + '.lstm_prep.parquet'
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(corpus_file):
+        return pd.read_parquet(cache_file)['text'].to_numpy()
+
+    cleaned_docs = np.array(preprocessing(documents), dtype=object)
+    pd.DataFrame({'text': cleaned_docs}).to_parquet(cache_file)
+
+    return cleaned_docs
+
+
+def get_emb_matrix(voc, words, vectors):
     """
     Function that gets embedding matrix given vocab and the embeddings
     Args:
         voc (list): vocabulary.
-        emb (dict): dictionary with words and their corresponding embeddings.
+        words (List[str]): words of the pretrained embeddings.
+        vectors (np.array): matrix with all pretrained embeddings.
 
     Returns:
         embedding_matrix (np.array): matrix with pretrained embeddings.
     """
 
     num_tokens = len(voc) + 2
-    word_index = dict(zip(voc, range(len(voc))))
-    # Bit hacky, get embedding dimension from the word "the"
-    embedding_dim = len(emb["the"])
-    # Prepare embedding matrix to the correct size
-    embedding_matrix = np.zeros((num_tokens, embedding_dim))
-    for word, i in word_index.items():
-        embedding_vector = emb.get(word)
-        if embedding_vector is not None:
-            # Words not found in embedding index will be all-zeros.
-            embedding_matrix[i] = embedding_vector
+    embedding_dim = vectors.shape[1]
+    # Only the (much smaller) vocabulary is indexed, the pretrained words are scanned once
+    # and just the rows of vocabulary words are copied out of the embedding vectors
+    word_to_idx = {word: idx for idx, word in enumerate(voc)}
+    rows, indices = [], []
+    for row, word in enumerate(words):
+        idx = word_to_idx.get(word)
+        if idx is not None:
+            rows.append(row)
+            indices.append(idx)
+    # Prepare embedding matrix to the correct size, words not found in embedding index will be all-zeros.
+    embedding_matrix = np.zeros((num_tokens, embedding_dim), dtype=np.float32)
+    embedding_matrix[indices] = vectors[rows]
     # Final matrix with pretrained embeddings that we can feed to embedding layer
     return embedding_matrix
 
 
+def get_vocab_path(train_file, dev_file, prep):
+    """
+    Function that gets path of the cached vocabulary for the given data.
+    Args:
+        train_file (str): Path to train file.
+        dev_file (str): Path to development file.
+        prep (bool): Whether the texts are preprocessed before vectorization.
+
+    Returns:
+        (str): path of the vocabulary file, it changes whenever the input data changes.
+    """
+    digest = hashlib.md5(str(prep).encode())
+    for corpus_file in (train_file, dev_file):
+        with open(corpus_file, 'rb') as f:
+            digest.update(f.read())
+
+    return "{}.{}.vocab.txt".format(train_file, digest.hexdigest()[:10])
+
+
 def create_model(
     Y_train,
     emb_matrix,
@@ -173,18 +309,21 @@ def create_model(
     optimizer,
     additional_dense,
     bidirectional,
-    hidden_size
+    hidden_size,
+    jit_compile=False
 ):
     """
     Function that creates the LSTM model.
     Args:
-        Y_train (list): list of labels.
+        Y_train (np.array): train labels.
         emb_matrix (dict): dictionary with words and their corresponding embeddings.
         learning_rate (float): learning rate for LSTM model.
-        dropout (float): dropout rate for LSTM layer.
+        dropout (float): dropout rate applied after the first LSTM layer.
         optimizer (str): set optimizer.
         additional_dense (bool): whether to use Dense layer after the Embedding layer.
         bidirectional (bool): whether to use Bidirectional LSTM.
+        hidden_size (int): number of units of the LSTM (and additional Dense) layers.
+        jit_compile (bool): whether to compile the whole train step with XLA.
 
     Returns:
         model: LSTM model.
@@ -202,7 +341,9 @@ def create_model(
     num_tokens = len(emb_matrix)
     num_labels = len(set(Y_train))
     
-    # Now build the model
+    # Now build the model. Padding (id 0) is masked, so the LSTMs give the same output no matter
+    # how much padding a batch has (train batches are bucketed by length, dev/test ones are not).
+    # Padding is always at the end of the texts, which the cuDNN kernel supports.
     model = Sequential()
     model.add(
         Embedding(
@@ -210,60 +351,120 @@ def create_model(
             embedding_dim,
             embeddings_initializer=Constant(emb_matrix),
             trainable=False,
+            mask_zero=True,
         )
     )
 
     if additional_dense:
         model.add(Dense(units=hidden_size))
 
+    # Keep the LSTM layers on the defaults required by the fused cuDNN kernel
+    # (tanh/sigmoid, bias, no unrolling, no recurrent dropout); dropout is applied
+    # as a separate layer so it stays outside of the recurrent cell.
+    cudnn_kwargs = dict(activation="tanh", recurrent_activation="sigmoid", use_bias=True, unroll=False)
+
     if bidirectional:
         model.add(
-            Bidirectional(LSTM(units=hidden_size, return_sequences=True, dropout=dropout))
+            Bidirectional(LSTM(units=hidden_size, return_sequences=True, **cudnn_kwargs))
         )
-        model.add(Bidirectional(LSTM(units=hidden_size)))
+        model.add(Dropout(dropout))
+        model.add(Bidirectional(LSTM(units=hidden_size, **cudnn_kwargs)))
     else:
-        model.add(LSTM(units=hidden_size, return_sequences=True, dropout=dropout))
-        model.add(LSTM(units=hidden_size))
-
-    # Ultimately, end with dense layer with softmax
-    model.add(Dense(units=1, activation="sigmoid"))
-    # Compile model using our settings, check for accuracy
-    model.compile(loss=loss_function, optimizer=optim, metrics=[f1])
+        model.add(LSTM(units=hidden_size, return_sequences=True, **cudnn_kwargs))
+        model.add(Dropout(dropout))
+        model.add(LSTM(units=hidden_size, **cudnn_kwargs))
+
+    # Ultimately, end with dense layer with sigmoid (kept in float32 for numerical stability)
+    model.add(Dense(units=1, activation="sigmoid", dtype="float32"))
+    # Compile model using our settings, check for F1 (counts are accumulated over the whole epoch,
+    # not averaged per batch)
+    model.compile(loss=loss_function, optimizer=optim, metrics=[F1Score(average="macro", threshold=0.5, name="f1")],
+                  jit_compile=jit_compile)
     return model
 
 
-def train_model(model, epochs, X_train, Y_train, X_dev, Y_dev, batch_size):
+def make_dataset(documents, labels, vectorizer, batch_size, shuffle=False, maxlen=None):
+    """
+    Function that builds a tf.data pipeline with vectorized texts.
+    Args:
+        documents (List[str]): list of texts.
+        labels (np.array): binarized labels.
+        vectorizer: adapted TextVectorization layer.
+        batch_size (int): batch size.
+        shuffle (bool): whether to reshuffle the data every epoch.
+        maxlen (int): if given, texts of similar length (up to maxlen tokens) are batched together
+            and padded only up to their bucket boundary instead of maxlen.
+
+    Returns:
+        dataset (tf.data.Dataset): batches of (vectorized texts, labels).
+    """
+    dataset = tf.data.Dataset.from_tensor_slices((documents, labels))
+    # Texts are vectorized only once (in big chunks) and the int32 token ids are cached in memory,
+    # every epoch then just shuffles and batches the cached ids
+    # (labels are cast to float32, as expected by the F1Score metric)
+    dataset = dataset.batch(1024).map(lambda x, y: (tf.cast(vectorizer(x), tf.int32), tf.cast(y, tf.float32)),
+                                      num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.unbatch().cache()
+    if shuffle:
+        dataset = dataset.shuffle(len(documents), seed=1234, reshuffle_each_iteration=True)
+
+    if maxlen:
+        # Cut the padding off (ids are padded with 0 at the end) and bucket texts by their length,
+        # so short tweets don't pay for maxlen timesteps. Only a few fixed shapes are produced.
+        dataset = dataset.map(lambda x, y: (x[:tf.math.count_nonzero(x, dtype=tf.int32)], y),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+        bucket_boundaries = [boundary for boundary in (10, 20, 30, 40) if boundary < maxlen] + [maxlen + 1]
+        dataset = dataset.bucket_by_sequence_length(
+            element_length_func=lambda x, y: tf.shape(x)[0],
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+            pad_to_bucket_boundary=True,
+        )
+    else:
+        dataset = dataset.batch(batch_size)
+    # In-memory data has no files to shard between replicas, so it's sharded by examples
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    # Next batches are prepared while the device trains on the current one
+    return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
+def train_model(model, epochs, train_ds, dev_ds, Y_dev):
     """
     Function to train the model.
     Args:
         model: LSTM model to train.
         epochs (int): number of epochs.
-        X_train (list): train documents.
-        Y_train (list): train_labels.
-        X_dev (list): development documents.
+        train_ds (tf.data.Dataset): batched train documents and labels.
+        dev_ds (tf.data.Dataset): batched development documents and labels.
         Y_dev (list): development labels.
-        batch_size (int): batch size.
 
     Returns:
         model: trained model.
     """
 
     verbose = 1
-    # Early stopping: stop training when there are three consecutive epochs without improving
+    # Halve the learning rate as soon as an epoch doesn't improve the dev loss
+    reduce_lr = tf.keras.callbacks.ReduceLROnPlateau(monitor="val_loss", factor=0.5, patience=1, min_lr=1e-5)
+    # Early stopping: stop training when there are two consecutive epochs without improving
+    # and go back to the weights of the best epoch.
     # It's also possible to monitor the training loss with monitor="loss"
-    callback = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=3)
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=2, restore_best_weights=True)
     # Finally fit the model to our data
     model.fit(
-        X_train,
-        Y_train,
+        train_ds,
         verbose=verbose,
         epochs=epochs,
-        callbacks=[callback],
-        batch_size=batch_size,
-        validation_data=(X_dev, Y_dev),
+        callbacks=[reduce_lr, early_stopping],
+        validation_data=dev_ds,
     )
-    # Print final accuracy for the model (clearer overview)
-    test_set_predict(model, X_dev, Y_dev, "dev")
+    # EarlyStopping only restores the best weights when it stops the training itself,
+    # so they are also restored when all the epochs ran
+    if early_stopping.best_weights is not None:
+        model.set_weights(early_stopping.best_weights)
+    # Print final macro F1 for the model (clearer overview). The val_f1 reported by Keras
+    # is the F1 of the positive class only, since the model has a single output.
+    test_set_predict(model, dev_ds, Y_dev, "dev")
     return model
 
 
@@ -282,88 +483,17 @@ def test_set_predict(model, X_test, Y_test, ident):
 
     # Get predictions using the trained model
     Y_pred = model.predict(X_test)
-    # Finally, convert to numerical labels to get scores with sklearn
-    #Y_pred = np.argmax(Y_pred, axis=1)
-    Y_pred=np.transpose(Y_pred)[0]  # transformation to get (n,)
-    # Applying transformation to get binary values predictions with 0.5 as thresold
-    Y_pred = list(map(lambda x: 0 if x<0.5 else 1, Y_pred))
-    Y_pred = np.array(Y_pred, dtype=np.int64)
+    # Finally, convert to numerical labels to get scores with sklearn:
+    # (n, 1) probabilities to (n,) binary predictions with 0.5 as threshold
+    Y_pred = (Y_pred.squeeze(-1) >= 0.5).astype(np.int64)
     # If you have gold data, you can calculate accuracy
-    Y_test = np.array(Y_test, dtype=np.int64)
-    print(Y_test[0])
-    print(Y_pred[0])
+    Y_test = np.asarray(Y_test, dtype=np.int64)
 
     f1 = f1_score(Y_test.flatten(), Y_pred, average="macro")
     print("F1 macro on own {1} set: {0}".format(round(f1, 3), ident))
     return Y_test, Y_pred
 
 
-def f1(y_true, y_pred):
-    """
-    F1 metric computation (because f1_score from sklearn.metrics doesn't work
-    when training model).
-
-    Args:
-        y_true (list): list of true labels.
-        y_pred (list): list of predicted labels.
-
-    Returns:
-        f1_score (float): F1 metric.
-    """
-
-    def recall(y_true, y_pred):
-        """
-        Recall metric.
-
-        Only computes a batch-wise average of recall.
-
-        Computes the recall, a metric for multi-label classification of
-        how many relevant items are selected.
-
-        Args:
-            y_true (list): list of true labels.
-            y_pred (list): list of predicted labels.
-
-        Returns:
-            recall (float): recall metric.
-        """
-        true_positives = K.sum(K.round(K.clip(y_true * y_pred, 0, 1)))
-        possible_positives = K.sum(K.round(K.clip(y_true, 0, 1)))
-        recall = true_positives / (possible_positives + K.epsilon())
-
-        return recall
-
-
-    def precision(y_true, y_pred):
-        """
-        Precision metric.
-
-        Only computes a batch-wise average of precision.
-
-        Computes the precision, a metric for multi-label classification of
-        how many selected items are relevant.
-
-        Args:
-            y_true (list): list of true labels.
-            y_pred (list): list of predicted labels.
-
-        Returns:
-            precision (float): precision metric.
-        """
-        true_positives = K.sum(K.round(K.clip(y_true * y_pred, 0, 1)))
-        predicted_positives = K.sum(K.round(K.clip(y_pred, 0, 1)))
-        precision = true_positives / (predicted_positives + K.epsilon())
-
-        return precision
-    
-    precision = precision(y_true, y_pred)
-    recall = recall(y_true, y_pred)
-
-    f1_score = 2*((precision*recall)/(precision+recall+K.epsilon()))
-
-    return f1_score
-
-
 if __name__ == "__main__":
     """
     Main function to train and test neural network given cmd line arguments.
@@ -374,16 +504,30 @@ if __name__ == "__main__":
     # Read in the data and embeddings
     train_documents, Y_train = read_corpus(args.train_file)
     dev_documents, Y_dev = read_corpus(args.dev_file)
+    if args.test_file:
+        test_documents, Y_test = read_corpus(args.test_file)
 
+    # Preprocessing forks worker processes, so it runs before TensorFlow touches the GPUs
     if args.prep:
-        train_documents = preprocessing(train_documents)
-        dev_documents = preprocessing(dev_documents)
+        train_documents = read_preprocessed(args.train_file, train_documents)
+        dev_documents = read_preprocessed(args.dev_file, dev_documents)
+        if args.test_file:
+            test_documents = read_preprocessed(args.test_file, test_documents)
 
-    embeddings = read_embeddings(args.embeddings)
+    # Enable XLA auto-clustering so the elementwise/gate ops get fused into single kernels
+    tf.config.optimizer.set_jit(True)
+
+    # Compute in float16 (weights stay in float32) to use Tensor Cores when a GPU is available
+    if tf.config.list_physical_devices("GPU"):
+        mixed_precision.set_global_policy("mixed_float16")
+
+    # Data parallel training over all the visible GPUs (falls back to a single device)
+    strategy = tf.distribute.MirroredStrategy()
 
     learning_rate = args.lr
     epochs = args.epochs
-    batch_size = args.batch_size
+    # Every replica gets batch_size examples per step
+    batch_size = args.batch_size * strategy.num_replicas_in_sync
     dropout = args.dropout
     optimizer = args.optimizer
     additional_dense = args.add_dense
@@ -393,49 +537,61 @@ if __name__ == "__main__":
 
     # Transform words to indices using a vectorizer
     vectorizer = TextVectorization(standardize=None, output_sequence_length=maxlen)
-    # Use train and dev to create vocab - could also do just train
-    text_ds = tf.data.Dataset.from_tensor_slices(train_documents + dev_documents)
-    vectorizer.adapt(text_ds)
+    # Use train and dev to create vocab - could also do just train.
+    # The vocab is cached, so the adapt pass only runs when the data changes.
+    vocab_path = get_vocab_path(args.train_file, args.dev_file, args.prep)
+    if os.path.exists(vocab_path):
+        with open(vocab_path, 'r', encoding='utf-8') as f:
+            vectorizer.set_vocabulary(f.read().split('\n'))
+    else:
+        text_ds = tf.data.Dataset.from_tensor_slices(np.concatenate([train_documents, dev_documents])).batch(1024)
+        vectorizer.adapt(text_ds)
+        with open(vocab_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(vectorizer.get_vocabulary()))
     # Dictionary mapping words to idx
     voc = vectorizer.get_vocabulary()
-    emb_matrix = get_emb_matrix(voc, embeddings)
-
-    # Transform string labels to one-hot encodings
-    encoder = LabelBinarizer()
-    Y_train_bin = encoder.fit_transform(Y_train)  # Use encoder.classes_ to find mapping back
+    # Embeddings are read once the vocabulary is known, only its rows are kept
+    emb_words, emb_vectors = read_embeddings(args.embeddings)
+    emb_matrix = get_emb_matrix(voc, emb_words, emb_vectors)
+    del emb_words, emb_vectors
+
+    # Transform string labels to one-hot encodings. The encoder is fitted on train only,
+    # dev and test are just transformed so all splits share the same class order.
+    encoder = LabelBinarizer().fit(Y_train)  # Use encoder.classes_ to find mapping back
+    Y_train_bin = encoder.transform(Y_train)
     Y_dev_bin = encoder.transform(Y_dev)
-    # Create model
-    model = create_model(
-        Y_train,
-        emb_matrix,
-        learning_rate,
-        dropout,
-        optimizer,
-        additional_dense,
-        bidirectional,
-        hidden_size
-    )
+    # Create model, its variables are mirrored on every replica
+    with strategy.scope():
+        model = create_model(
+            Y_train,
+            emb_matrix,
+            learning_rate,
+            dropout,
+            optimizer,
+            additional_dense,
+            bidirectional,
+            hidden_size,
+            args.jit_compile
+        )
 
     # Transform input to vectorized input
     print(train_documents[0])
-    X_train_vect = vectorizer(np.array([[s] for s in train_documents])).numpy()
-    X_dev_vect = vectorizer(np.array([[s] for s in dev_documents])).numpy()
+    # Train batches are bucketed by length, dev batches keep the full maxlen.
+    # The last incomplete batch of every bucket is kept (train and dev use all their examples):
+    # it only adds a few more shapes to compile, while dropping them would skip ~4% of the
+    # train texts every epoch.
+    train_ds = make_dataset(train_documents, Y_train_bin, vectorizer, batch_size, shuffle=True,
+                            maxlen=maxlen)
+    dev_ds = make_dataset(dev_documents, Y_dev_bin, vectorizer, batch_size)
 
     # Train the model
-    model = train_model(
-        model, epochs, X_train_vect, Y_train_bin, X_dev_vect, Y_dev_bin, batch_size
-    )
+    model = train_model(model, epochs, train_ds, dev_ds, Y_dev_bin)
 
     # Do predictions on specified test set
     if args.test_file:
-        # Read in test set and vectorize
-        test_documents, Y_test = read_corpus(args.test_file)
-
-        if args.prep:
-            test_documents = preprocessing(test_documents)
-
+        # Vectorize the test set (read in and preprocessed above)
         Y_test_bin = encoder.transform(Y_test)
-        X_test_vect = vectorizer(np.array([[s] for s in test_documents])).numpy()
+        X_test_vect = vectorizer(tf.constant(test_documents, dtype=tf.string)).numpy()
 
         # Finally do the predictions
         Y_test, Y_pred = test_set_predict(model, X_test_vect, Y_test_bin, "test")
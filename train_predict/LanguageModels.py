@@ -4,15 +4,20 @@
 
 # Import all necessary libraries.
 import pandas as pd
+import pyarrow.csv as pacsv
 import numpy as np
+import os
 import random
+import hashlib
 import argparse
 import torch
+import datasets
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from transformers import TrainingArguments, Trainer
+from transformers import TrainingArguments, Trainer, DataCollatorWithPadding
 from sklearn.metrics import f1_score
 import emoji
-from wordsegment import load, segment
+from hashtags import segment_hashtag
+
 
 
 def create_arg_parser():
@@ -44,21 +49,6 @@ def create_arg_parser():
     return args
 
 
-class Data(torch.utils.data.Dataset):
-
-    def __init__(self, encodings, labels):
-        self.encodings = encodings
-        self.labels = labels
-        
-    def __getitem__(self, idx):
-        item = {k: torch.tensor(v[idx]) for k, v in self.encodings.items()}
-        item["labels"] = torch.tensor([self.labels[idx]])
-        return item
-    
-    def __len__(self):
-        return len(self.labels)
-
-
 def read_corpus(corpus_file):
     """
     Function that reads the corpus and gets texts and labels from it.
@@ -69,13 +59,13 @@ def read_corpus(corpus_file):
     Returns:
         documents (List[str]), labels (List[str]): 2 lists of texts and labels respectively.
     """
-    documents = []
-    labels = []
+    corpus = pacsv.read_csv(corpus_file,
+                            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+                            parse_options=pacsv.ParseOptions(delimiter='\t', newlines_in_values=True))
 
-    corpus = pd.read_table(corpus_file, names=['text', 'label'], header=None)
-    
-    documents = corpus['text'].to_list()
-    labels = corpus['label'].to_list()
+    # Preprocessed files also contain an index column, texts and labels are always the last two columns
+    documents = corpus.column(corpus.num_columns - 2).to_pylist()
+    labels = corpus.column(corpus.num_columns - 1).to_pylist()
 
     return documents, labels
 
@@ -89,19 +79,15 @@ def preprocessing(documents):
     Returns:
         cleaned_hash_docs (List[str]): list of cleaned and preprocessed texts.
     """
-    cleaned_user_docs = [doc.replace('@USER', '') for doc in documents]
-    cleaned_url_docs = [doc.replace('URL', 'http') for doc in cleaned_user_docs]
-    cleaned_emoji_docs = [emoji.demojize(doc) for doc in cleaned_url_docs]
-
     cleaned_hash_docs = []
-    for doc in cleaned_emoji_docs:
+    for doc in documents:
+        doc = doc.replace('@USER', '').replace('URL', 'http')
+        doc = emoji.demojize(doc)
+
         cleaned_doc = ''
         for word in doc.split():
             if word.startswith("#"):
-                word = word.replace("#", "")
-                load()
-                word_list = segment(word)
-                word = ' '.join(word_list)
+                word = segment_hashtag(word.replace("#", ""))
             cleaned_doc = cleaned_doc + ' ' + word
         cleaned_doc = " ".join(cleaned_doc.split())
         cleaned_hash_docs.append(cleaned_doc)
@@ -129,24 +115,54 @@ def seed_all(seed_value):
         torch.backends.cudnn.deterministic = False
 
 
-def get_tokens(tokenizer, documents):
+def get_cache_path(model_name, corpus_file, prep):
     """
-    Function to tokenize texts.
+    Function to get the path of the cached tokenized dataset.
+    Args:
+        model_name (str): name of the model (defines the tokenizer).
+        corpus_file (str): Path to corpus file.
+        prep (bool): whether texts are preprocessed before tokenization.
+
+    Returns:
+        (str): path of the cached dataset, it changes whenever the model or the data changes.
+    """
+    digest = hashlib.md5((model_name + str(prep)).encode())
+    with open(corpus_file, 'rb') as f:
+        digest.update(f.read())
+
+    return os.path.join('./train_clf/cache', digest.hexdigest())
+
+
+def get_dataset(tokenizer, documents, labels, cache_path, training_args):
+    """
+    Function to tokenize texts. The tokenized dataset is saved to disk,
+    so next runs load it instead of tokenizing again.
     Args:
         tokenizer: model tokenizer.
         documents (List[str]): list of texts.
+        labels (List[int]): list of labels.
+        cache_path (str): where the tokenized dataset is cached.
+        training_args (TrainingArguments): training arguments (define the distributed setup).
 
     Returns:
-        tokens (dict): embedded tokens.
+        dataset (datasets.Dataset): dataset with texts, labels and embedded tokens.
     """
+    # When training on several GPUs only the main process tokenizes and saves the dataset,
+    # the other ones wait for it and load the saved dataset
+    with training_args.main_process_first(desc="dataset tokenization"):
+        if os.path.exists(cache_path):
+            return datasets.load_from_disk(cache_path)
 
-    tokens = tokenizer.batch_encode_plus(
-        documents,
-        max_length = 64,
-        padding = 'max_length',
-        truncation = True)
+        dataset = datasets.Dataset.from_dict({'text': documents, 'label': labels})
+        # No padding here: batches are padded dynamically to their longest text by the data collator
+        dataset = dataset.map(lambda batch: tokenizer(batch['text'], max_length=64, truncation=True),
+                              batched=True, num_proc=os.cpu_count())
+        # Saved to a temporary directory first, so an interrupted save is never taken for a cached dataset
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        dataset.save_to_disk(tmp_path)
+        os.replace(tmp_path, cache_path)
 
-    return tokens
+    return dataset
 
 
 def compute_metrics(pred):
@@ -164,26 +180,30 @@ def compute_metrics(pred):
     return {'F1': f1}
 
 
-def train(model, tokenizer, train_dataset, dev_dataset, n_epoch, lr):
+def get_training_args(n_epoch, lr):
     """
-    Train the model.
+    Get the arguments for training.
     Args:
-        model: model to train.
-        tokenizer: tokenizer.
-        train_dataset (dict): train set.
-        dev_dataset (dict): development set.
         n_epoch (int): number of epochs.
         lr (float): learning rate.
 
     Returns:
-        trainer: trained model.
+        training_args (TrainingArguments): training arguments.
     """
 
+    # TF32 matmuls are only supported starting from Ampere GPUs
+    use_tf32 = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+
     training_args = TrainingArguments(
         output_dir = './train_clf/results',
         num_train_epochs = n_epoch,
         per_device_train_batch_size = 32,
-        per_device_eval_batch_size = 32,
+        # No gradients are stored during evaluation, so it can use bigger batches
+        per_device_eval_batch_size = 64,
+        fp16 = True,
+        tf32 = use_tf32,
+        dataloader_num_workers = 4,
+        dataloader_pin_memory = True,
         weight_decay =0.01,
         logging_dir = './train_clf/logs',
         load_best_model_at_end = True,
@@ -194,9 +214,30 @@ def train(model, tokenizer, train_dataset, dev_dataset, n_epoch, lr):
         save_total_limit = 1,
         seed=42)
 
+    return training_args
+
+
+def train(model, tokenizer, train_dataset, dev_dataset, training_args):
+    """
+    Train the model.
+    Args:
+        model: model to train.
+        tokenizer: tokenizer.
+        train_dataset (datasets.Dataset): train set.
+        dev_dataset (datasets.Dataset): development set.
+        training_args (TrainingArguments): training arguments.
+
+    Returns:
+        trainer: trained model.
+    """
+
+    # Pad to a multiple of 8 to keep tensor shapes Tensor Core friendly
+    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+
     trainer = Trainer(model=model,
                     tokenizer = tokenizer,
                     args = training_args,
+                    data_collator = data_collator,
                     train_dataset = train_dataset,
                     eval_dataset = dev_dataset,
                     compute_metrics = compute_metrics)
@@ -211,7 +252,7 @@ def get_prediction(trainer, test_documents):
     Make predictions on given set of texts.
     Args:
         trainer: model to make predictions.
-        test_documents (List[str]): list of texts.
+        test_documents (datasets.Dataset): tokenized texts.
 
     Returns:
         labels (List[int]): list of predicted values.
@@ -246,17 +287,19 @@ if __name__ == "__main__":
     Y_dev = [label_to_idx[i] for i in Y_dev]
 
     # Model initialization. Data tokenization.
+    # Trainer places the model on the right device (one GPU per process when launched distributed)
     model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=2,
-                                                               ignore_mismatched_sizes=True).to("cuda")
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
+                                                               ignore_mismatched_sizes=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
 
-    train_tokens = get_tokens(tokenizer, train_documents)
-    dev_tokens = get_tokens(tokenizer, dev_documents)
+    training_args = get_training_args(args.epochs, args.lr)
 
-    train_dataset = Data(train_tokens, Y_train)
-    dev_dataset = Data(dev_tokens, Y_dev)
+    train_dataset = get_dataset(tokenizer, train_documents, Y_train,
+                                get_cache_path(args.model, args.train_file, args.prep), training_args)
+    dev_dataset = get_dataset(tokenizer, dev_documents, Y_dev,
+                              get_cache_path(args.model, args.dev_file, args.prep), training_args)
 
-    trainer = train(model, tokenizer, train_dataset, dev_dataset, args.epochs, args.lr)
+    trainer = train(model, tokenizer, train_dataset, dev_dataset, training_args)
 
     # If test file specified, predictions will be calculated.
     if args.test_file:
@@ -267,17 +310,18 @@ if __name__ == "__main__":
 
         Y_test = [label_to_idx[i] for i in Y_test]
         
-        test_tokens = get_tokens(tokenizer, test_documents)
-        test_dataset = Data(test_tokens, Y_test)
+        test_dataset = get_dataset(tokenizer, test_documents, Y_test,
+                                   get_cache_path(args.model, args.test_file, args.prep), training_args)
 
         y_preds = get_prediction(trainer, test_dataset)
 
-        # Saving output
-        data = {'text': test_documents, 'label': [idx_to_label[i] for i in y_preds]} 
-        df = pd.DataFrame(data)
+        # Saving output (only once when training on several GPUs)
+        if trainer.is_world_process_zero():
+            data = {'text': test_documents, 'label': [idx_to_label[i] for i in y_preds]} 
+            df = pd.DataFrame(data)
 
-        model_name = args.model
-        if '/' in model_name:
-            model_name = model_name.split('/')[1]
-        
-        df.to_csv('output/LMs/{}_preds.tsv'.format(model_name), sep="\t", header=False) 
+            model_name = args.model
+            if '/' in model_name:
+                model_name = model_name.split('/')[1]
+            
+            df.to_csv('output/LMs/{}_preds.tsv'.format(model_name), sep="\t", header=False) 
@@ -6,21 +6,23 @@
 import numpy as np
 import pandas as pd
 import argparse
+import os
 import spacy
 import matplotlib.pyplot as plt
 import seaborn as sn
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import LinearSVC
 from sklearn.pipeline import Pipeline
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.metrics import f1_score
 from sklearn.model_selection import GridSearchCV
 import random
 import emoji
-from wordsegment import load, segment
+from hashtags import segment_hashtag
 
 # Random seed to prevent actual randomness when reruning the code.
 random.seed(42)
@@ -85,6 +87,10 @@ def create_arg_parser():
     parser.add_argument("-ng", "--ngram", default="(1,3)",
                         type=tuple_type, help="Set ngram size for vectorizer (default (1,1)",)
 
+    parser.add_argument("--hashing", action="store_true",
+                        help="Hash n-grams into a fixed number of features instead of building a vocabulary \
+                        (default False)",)
+
     # Required argument
     requiredNamed = parser.add_argument_group("required arguments")
 
@@ -136,12 +142,29 @@ def read_corpus(corpus_file):
     return documents, labels
 
 
-def text_preprocessing(text, lemmatize=False, add_prep=False):
+def lemmatize_texts(texts):
+    """
+    Function that lemmatizes texts using SpaCy. Texts are processed in batches
+    by several worker processes instead of one spacy_model call per text.
+    Args:
+        texts (List[str]): List of texts
+
+    Returns:
+        lemmatized_texts (List[str]): list of lemmatized texts.
+    """
+    # Only tagger and attribute_ruler are needed by the lemmatizer, parser and NER are skipped
+    docs = spacy_model.pipe(texts, n_process=-1, batch_size=1000, disable=["parser", "ner"])
+    lemmatized_texts = [" ".join([token.lemma_ for token in doc]) for doc in docs]
+
+    return lemmatized_texts
+
+
+def text_preprocessing(text, add_prep=False):
     """
-    Function that processes the text (i.e., lemmatization, punctuation removal)
+    Function that processes the text (i.e., punctuation removal)
     Args:
-        word_tokens (List[str]): List of words
-        lemmatize (bool): Whether to lemmatize words from text
+        text (str): Text to process
+        add_prep (bool): Whether to additionally clean the text
 
     Returns:
         words.split() (List[str]): list of (preprocesses) words.
@@ -151,12 +174,6 @@ def text_preprocessing(text, lemmatize=False, add_prep=False):
     # Otherwise, it's overwriten and returned.
     words = text
 
-    # Lemmatization of text using SpaCy
-    if lemmatize:
-        doc = spacy_model(words)
-        lemmas_list = [token.lemma_ for token in doc]
-        words = " ".join(lemmas_list)
-
     # Additional preprocessing cleaning step which is used by default in this task.
     # However, it's time consuming. 
     # For this purpose we created preprocessed files so we don't call this argument each time.
@@ -168,10 +185,7 @@ def text_preprocessing(text, lemmatize=False, add_prep=False):
         clean_text = ''
         for word in words.split():
             if word.startswith("#"):
-                word = word.replace("#", "")
-                load()
-                word_list = segment(word)
-                word = ' '.join(word_list)
+                word = segment_hashtag(word.replace("#", ""))
             clean_text = clean_text + ' ' + word
         clean_text = " ".join(clean_text.split())
         
@@ -180,6 +194,39 @@ def text_preprocessing(text, lemmatize=False, add_prep=False):
     return words.split()
 
 
+def preprocess_documents(documents, corpus_file, lemmatize=False, add_prep=False):
+    """
+    Function that processes all the texts (i.e., lemmatization, punctuation removal).
+    Lemmatized/cleaned texts are cached next to the corpus file, so they are only
+    processed again when the file changes.
+    Args:
+        documents (List[str]): List of texts
+        corpus_file (str): Path to corpus file the texts are read from
+        lemmatize (bool): Whether to lemmatize words from texts
+        add_prep (bool): Whether to additionally clean texts
+
+    Returns:
+        (List[List[str]]): list of (preprocesses) words for every text.
+    """
+    # Nothing to cache if the texts are only split into words
+    if not lemmatize and not add_prep:
+        return [text_preprocessing(text) for text in documents]
+
+    steps = [step for step, used in (("lem", lemmatize), ("prep", add_prep)) if used]
+    cache_file = "{}.nb_{}.parquet".format(corpus_file, "_".join(steps))
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(corpus_file):
+        return [text.split() for text in pd.read_parquet(cache_file)["text"]]
+
+    # Lemmatization of texts using SpaCy, done for all the texts at once
+    if lemmatize:
+        documents = lemmatize_texts(documents)
+
+    processed_documents = [text_preprocessing(text, add_prep=add_prep) for text in documents]
+    pd.DataFrame({"text": [" ".join(words) for words in processed_documents]}).to_parquet(cache_file)
+
+    return processed_documents
+
+
 def grid_search(params, model, X_train, y_train, model_name):
     """
     Function to search for the best hyperparameters for the selected model.
@@ -189,13 +236,39 @@ def grid_search(params, model, X_train, y_train, model_name):
         X_train (List[str]): Train texts.
         y_train (List[str]): Train labels.
     Returns:
-        grid_search.best_estimator_ (estimator): Estimator with the best hyperparameters.
+        best_model (pipeline): Unfitted pipeline with the best hyperparameters.
+    """
+    # Only classifier hyperparams are searched, so the texts are vectorized once
+    # and the search runs on the classifier alone instead of refitting the vectorizer
+    # for every fold and candidate.
+    X_train_vect = clone(model.named_steps["vec"]).fit_transform(X_train)
+    cls_params = {name.replace("cls__", "", 1): values for name, values in params.items()}
+    # refit=False: only best_params_ is used, the best pipeline is fitted by the caller
+    grid_search = GridSearchCV(model.named_steps["cls"], cls_params, cv=5, verbose=5, n_jobs=-1,
+                               refit=False)
+    grid_search.fit(X_train_vect, y_train)
+
+    # Pipeline with the best hyperparams, it's fitted on the texts afterwards
+    best_model = clone(model).set_params(
+        **{"cls__" + name: value for name, value in grid_search.best_params_.items()})
+    print("Best parameters for the {} model are:".format(model_name), best_model)
+    return best_model
+
+
+class SeenColumns(BaseEstimator, TransformerMixin):
     """
-    grid_search = GridSearchCV(model, params, cv=5, verbose=5, n_jobs=-1)
-    grid_search.fit(X_train, y_train)
+    Keeps only the columns of hashed n-gram counts that are used by some train text.
+    N-grams never seen in training are then ignored (instead of getting the maximum idf),
+    and the classifiers don't see millions of empty columns (e.g. in NB smoothing),
+    the same way as with the vocabulary of TfidfVectorizer/CountVectorizer.
+    """
+
+    def fit(self, X, y=None):
+        self.columns_ = np.flatnonzero(X.getnnz(axis=0))
+        return self
 
-    print("Best parameters for the {} model are:".format(model_name), grid_search.best_estimator_)
-    return grid_search.best_estimator_
+    def transform(self, X):
+        return X[:, self.columns_]
 
 
 def identity(inp):
@@ -217,17 +290,25 @@ if __name__ == "__main__":
     dev_documents, Y_dev = read_corpus(args.dev_file)
 
     # Preprocess data if any preprocessing steps are specified in the command line.
-    X_train = [
-        text_preprocessing(text, lemmatize=args.lem, add_prep=args.add_prep)
-        for text in train_documents]
-    X_dev = [
-        text_preprocessing(text, lemmatize=args.lem, add_prep=args.add_prep)
-        for text in dev_documents]
+    X_train = preprocess_documents(train_documents, args.train_file, lemmatize=args.lem, add_prep=args.add_prep)
+    X_dev = preprocess_documents(dev_documents, args.dev_file, lemmatize=args.lem, add_prep=args.add_prep)
 
     # Split the data to train/test sets.
     # X_train, X_test, y_train, y_test = split_data(clean_documents, labels)
 
-    if args.vect == "tfidf":
+    if args.hashing:
+        # Stateless vectorizer: n-grams are hashed into 2**20 columns, so no vocabulary dict is built.
+        # Only positive counts (NB needs them), just the columns seen in training are kept,
+        # tfidf weighting and normalization are applied on top.
+        vec = HashingVectorizer(
+            preprocessor=identity, tokenizer=identity, ngram_range=args.ngram,
+            n_features=2**20, alternate_sign=False, norm=None
+        )
+        steps = [("hash", vec), ("seen", SeenColumns())]
+        if args.vect == "tfidf":
+            steps.append(("tfidf", TfidfTransformer()))
+        vec = Pipeline(steps)
+    elif args.vect == "tfidf":
         # TfIdf vectorizer with chosen n-grams specified in the command line.
         vec = TfidfVectorizer(
             preprocessor=identity, tokenizer=identity, ngram_range=args.ngram
@@ -239,26 +320,25 @@ if __name__ == "__main__":
         )
 
     # Handle 5 different classifiers and their params based on the arguments from the command line.
-    # Each one then is combined with the chosen vectorizer.
     if args.model == "nb":
-        classifier = Pipeline([("vec", vec), ("cls", MultinomialNB(alpha=args.alpha))])
+        cls = MultinomialNB(alpha=args.alpha)
 
     elif args.model == "dt":
-        classifier = Pipeline([("vec", vec), 
-                               ("cls", DecisionTreeClassifier(criterion=args.criterion, max_depth=args.max_depth),),])
+        cls = DecisionTreeClassifier(criterion=args.criterion, max_depth=args.max_depth)
+
     elif args.model == "rf":
-        classifier = Pipeline([("vec", vec), 
-                               ("cls", RandomForestClassifier(n_estimators=args.n_est, 
-                                                              criterion=args.criterion, 
-                                                              max_depth=args.max_depth,),),])
-        
+        # Trees are built in parallel on all the cores
+        cls = RandomForestClassifier(n_estimators=args.n_est, criterion=args.criterion,
+                                     max_depth=args.max_depth, n_jobs=-1)
+
     elif args.model == "knn":
-        classifier = Pipeline([("vec", vec), 
-                               ("cls", KNeighborsClassifier(n_neighbors=args.n_neigh, 
-                                                            weights=args.weights),),])
+        cls = KNeighborsClassifier(n_neighbors=args.n_neigh, weights=args.weights)
 
     elif args.model == "svm":
-        classifier = Pipeline([("vec", vec), ("cls", LinearSVC(C=args.C))])
+        cls = LinearSVC(C=args.C)
+
+    # The chosen classifier is then combined with the chosen vectorizer.
+    classifier = Pipeline([("vec", vec), ("cls", cls)])
 
     # Apply gridsearch if it's called from the command line.
     if args.find_params:
@@ -306,9 +386,7 @@ if __name__ == "__main__":
     if args.test_file:
         # Read in test set and vectorize
         test_documents, Y_test = read_corpus(args.test_file)
-        X_test = [
-        text_preprocessing(text, lemmatize=args.lem, add_prep=args.add_prep)
-        for text in test_documents]
+        X_test = preprocess_documents(test_documents, args.test_file, lemmatize=args.lem, add_prep=args.add_prep)
 
         Y_pred = best_model.predict(X_test)
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Hashtag segmentation shared by the training scripts. Segmented hashtags are cached
+on disk, so every hashtag is only segmented once instead of on every run.
+"""
+
+import atexit
+import json
+import os
+from wordsegment import load, segment
+
+# Load wordsegment unigram/bigram counts only once
+load()
+
+
+def load_hashtag_cache(cache_file):
+    """
+    Function that loads the hashtag segmentations saved by the previous runs.
+    Args:
+        cache_file (str): Path to cache file.
+
+    Returns:
+        (dict): mapping from hashtags to their words joined with spaces.
+    """
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# The cache file is shared by all the scripts (paths are relative to the repository root)
+HASHTAG_CACHE_FILE = 'dataset/hashtag_cache.json'
+hashtag_cache = load_hashtag_cache(HASHTAG_CACHE_FILE)
+saved_cache_size = len(hashtag_cache)
+
+
+@atexit.register
+def save_hashtag_cache():
+    """
+    Function that saves the hashtag segmentations if new hashtags were segmented.
+    The file is replaced at once, so a concurrent run never reads half of it.
+    """
+    global saved_cache_size
+    if len(hashtag_cache) == saved_cache_size:
+        return
+
+    os.makedirs(os.path.dirname(HASHTAG_CACHE_FILE), exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(HASHTAG_CACHE_FILE, os.getpid())
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(hashtag_cache, f, ensure_ascii=False)
+    os.replace(tmp_file, HASHTAG_CACHE_FILE)
+    saved_cache_size = len(hashtag_cache)
+
+
+def segment_hashtag(hashtag):
+    """
+    Function to split a hashtag into words. Results are cached because
+    hashtags repeat a lot across tweets (and runs).
+    Args:
+        hashtag (str): hashtag without the # sign.
+
+    Returns:
+        (str): words of the hashtag joined with spaces.
+    """
+    words = hashtag_cache.get(hashtag)
+    if words is None:
+        words = hashtag_cache[hashtag] = ' '.join(segment(hashtag))
+    return words